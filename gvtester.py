@@ -1,32 +1,46 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 # vim: set shiftwidth=4 tabstop=4 expandtab softtabstop=4:
-from __future__ import print_function
 import os
 import sys
 import argparse
 import logging
 import re
-import subprocess
+import asyncio
+import signal
 import pickle
 import time
-import string
-try:
-    # Python 2.x
-    from Queue import Queue
-except ImportError:
-    # Python 3.x
-    from queue import Queue
-
-import threading
-import multiprocessing # Only for determining number of CPU cores available
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple
 
 from GPUVerify import ErrorCodes
 
-GPUVerifyExecutable=sys.path[0] + os.sep + "GPUVerify.py"
+GPUVerifyExecutable=os.path.join(sys.path[0], "GPUVerify.py")
 
 printBarWidth=80
 
+#Matches the first line of a kernel which gives the expected test outcome
+expectedOutcomeRegex=re.compile(r'^//(pass|xfail:([A-Z_]+))',re.IGNORECASE)
+
+#Matches the header of a kernel (after decodeKernelHeader()) capturing
+#the expected outcome line, the command line arguments line and the block
+#of regex lines. This always matches, the captured lines are validated later.
+kernelHeaderRegex=re.compile(r'([^\n]*)\n?([^\n]*)\n?((?://[^\n]+(?:\n|$))*)')
+
+#Matches variables (e.g. ${KERNEL_DIR} or $KERNEL_DIR) in command line arguments
+#of a kernel. Like string.Template "$$" is an escaped "$"
+cmdArgsVariableRegex=re.compile(r'\$(?:\{(\w+)\}|(\w+)|\$)')
+
+#The number of bytes to read from the start of a kernel when looking for its header
+kernelHeaderReadSize=4096
+
+#The flags of a regex compiled with re.MULTILINE and no inline flags
+defaultRegexFlags=re.compile('', re.MULTILINE).flags
+
+#Matches the line of nine comma separated values printed by GPUVerify's --time-as-csv
+csvLineRegex=re.compile(r'^[^,\n]*(,[^,\n]*){8}$',re.MULTILINE)
+
 class GPUVerifyErrorCodes(ErrorCodes):
     """ Provides extra error codes and a handy dictionary
         to map error codes to strings.
@@ -40,6 +54,10 @@ class GPUVerifyErrorCodes(ErrorCodes):
     REGEX_MISMATCH_ERROR=100
 
     errorCodeToString = {} #Overwritten by static_init()
+    validxfailCodes = () #Overwritten by static_init()
+    validxfailCodeNames = frozenset() #Overwritten by static_init()
+    _minCode = 0 #Overwritten by static_init()
+    _codeTable = [] #Overwritten by static_init()
     @classmethod
     def static_init(cls):
         base=cls.__bases__[0] #Get our parent class
@@ -61,18 +79,32 @@ class GPUVerifyErrorCodes(ErrorCodes):
         for (num,string) in [( getattr(cls,x), x)  for x in codes if type(getattr(cls,x)) == int]:
             cls.errorCodeToString[num]=string
 
+        #Build a table indexed by (num - _minCode) so that looking up the
+        #name of an error code doesn't need to hash it
+        cls._minCode=min(cls.errorCodeToString)
+        cls._codeTable=[None]*(max(cls.errorCodeToString) - cls._minCode + 1)
+        for (num,string) in cls.errorCodeToString.items():
+            cls._codeTable[num - cls._minCode]=string
+
+        #Build the (num,string) tuples of codes that can be used with xfail.
+        #Skip SUCCESS and REGEX_MISMATCH_ERROR as it isn't sensible to expect a failure
+        # at these points.
+        cls.validxfailCodes=tuple( codeTuple for codeTuple in cls.errorCodeToString.items()
+                                   if codeTuple[0] not in (cls.SUCCESS, cls.REGEX_MISMATCH_ERROR) )
+        cls.validxfailCodeNames=frozenset( t[1] for t in cls.validxfailCodes )
+
     @classmethod
     def getValidxfailCodes(cls):
-        codes=[]
-        for codeTuple in cls.errorCodeToString.items():
-            #Skip SUCCESS and REGEX_MISMATCH_ERROR as it isn't sensible to expect a failure
-            # at these points.
-            if codeTuple[0] == cls.SUCCESS or codeTuple[0] == cls.REGEX_MISMATCH_ERROR :
-                continue
-            else:
-                codes.append(codeTuple)
+        return cls.validxfailCodes
 
-        return codes
+    @classmethod
+    def codeToString(cls, code):
+        #Behave like errorCodeToString[code] for codes that have no name,
+        #including those that fall in the gaps of the table or outside it
+        index=code - cls._minCode
+        if 0 <= index < len(cls._codeTable) and cls._codeTable[index] is not None:
+            return cls._codeTable[index]
+        raise KeyError(code)
 
 
 #Perform the initialisation
@@ -88,9 +120,31 @@ def enum(*sequential):
 
 GPUVerifyTesterErrorCodes=enum('SUCCESS', 'FILE_SEARCH_ERROR','KERNEL_PARSE_ERROR', 'TEST_FAILED', 'FILE_OPEN_ERROR', 'GENERAL_ERROR')
 
+# The outcome of GPUVerifyTestKernel.run()
+GPUVerifyTestResult=namedtuple('GPUVerifyTestResult', ['testPassed', 'returnedCode', 'gpuverifyReturnCode', 'regex', 'csvLine'])
+
+def decodeKernelHeader(rawHeader):
+    """ Converts bytes read from the start of a kernel into a string
+        with UNIX line endings so DOS format (groan) kernels can be parsed.
+    """
+    rawHeader=rawHeader.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return rawHeader.decode('utf-8', 'replace')
+
+def killProcessGroup(processInstance):
+    """ Kill a process started by GPUVerifyTestKernel.run() along with any
+        tools (e.g. clang, Boogie or Z3) it is running.
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(processInstance.pid, signal.SIGKILL)
+        else:
+            processInstance.kill()
+    except ProcessLookupError:
+        pass # Already finished
+
 class GPUVerifyTestKernel(object):
 
-    def __init__(self,path,timeAsCSV,csvFile,additionalOptions=None):
+    def __init__(self,path,timeAsCSV,additionalOptions=None):
         """
 
             Initialise CUDA/OpenCL GPUVerify test.
@@ -102,185 +156,257 @@ class GPUVerifyTestKernel(object):
             .expectedReturnCode : The expected return code of GPUVerify
             .gpuverifyCmdArgs   : A list of command line arguments to pass to GPUVerify
             .regex              : A dictionary of regular expressions that map to Success True/False
+            .compiledRegex      : A dictionary mapping the regular expressions to their compiled form
+            .combinedRegex      : A single alternation of the regular expressions (or None) used
+                                  to scan the output once. Its i-th group is combinedRegexKeys[i]
+            .kernelDir          : The directory containing the test kernel
+            .cmdLine            : The command line used to run GPUVerify on the test kernel
         """
-        logging.debug("Parsing kernel \"{0}\" for test parameters".format(path))
+        logging.debug("Parsing kernel \"%s\" for test parameters", path)
         self.path=path
+        self.kernelDir=os.path.dirname(path)
         self.timeAsCSV=timeAsCSV
-        self.csvFile = csvFile
 
         #Use with so that if exception thrown file is still closed
-        #Note need to use universal line endings to handle DOS format (groan) kernels
-        with open(self.path,'rU') as fileObject:
-
-            #Grab expected test outcome
-            expectedOutcome=fileObject.readline()
-            regexOutcome=re.compile(r'^//(pass|xfail:([A-Z_]+))',re.IGNORECASE)
-            matched=regexOutcome.match(expectedOutcome)
-
-            #Note that we store the expectedReturnCode in integer form (not the string form)
-            if matched == None:
-                raise KernelParseError(1,self.path,"First Line should say \"//pass\" or \"//xfail:<ERROR_CODE>\"")
+        with open(self.path,'rb') as fileObject:
+            #The header is at the start of the kernel so try not to read all of it
+            rawHeader=fileObject.read(kernelHeaderReadSize)
+            header=decodeKernelHeader(rawHeader)
+            matched=kernelHeaderRegex.match(header)
+            if len(rawHeader) == kernelHeaderReadSize and '\n' not in header[matched.end():]:
+                #The header might continue past what we have read (possibly
+                #with a regex line that was cut off before its leading //)
+                header=decodeKernelHeader(rawHeader + fileObject.read())
+                matched=kernelHeaderRegex.match(header)
+
+        (expectedOutcome, cmdArgs, regexLines)=matched.groups()
+
+        #Grab expected test outcome
+        matched=expectedOutcomeRegex.match(expectedOutcome)
+
+        #Note that we store the expectedReturnCode in integer form (not the string form)
+        if matched == None:
+            raise KernelParseError(1,self.path,"First Line should say \"//pass\" or \"//xfail:<ERROR_CODE>\"")
+        else:
+            if(matched.group(1).lower() == "pass"): 
+                self.expectedReturnCode=GPUVerifyErrorCodes.SUCCESS
             else:
-                if(matched.group(1).lower() == "pass"): 
-                    self.expectedReturnCode=GPUVerifyErrorCodes.SUCCESS
+                xfailCodeAsString=matched.group(2).upper()
+                if xfailCodeAsString in GPUVerifyErrorCodes.validxfailCodeNames:
+                    self.expectedReturnCode=getattr(GPUVerifyErrorCodes,xfailCodeAsString)
                 else:
-                    xfailCodeAsString=matched.group(2).upper()
-                    if xfailCodeAsString in [ t[1] for t in GPUVerifyErrorCodes.getValidxfailCodes() ]:
-                        self.expectedReturnCode=getattr(GPUVerifyErrorCodes,xfailCodeAsString)
-                    else:
-                        raise KernelParseError(1,self.path, "\"" + xfailCodeAsString + "\" is not a valid error code for expected fail.")
-
-
-            #Grab command line args to pass to GPUVerify
-            cmdArgs=fileObject.readline()
-            #Slightly naive test
-            if not cmdArgs.startswith('//'):
-                raise KernelParseError(2,self.path,"Second Line should start with \"//\" and then optionally space seperate arguments to pass to GPUVerify")
-
-            self.gpuverifyCmdArgs = cmdArgs[2:].strip().split() #Split on spaces
-
-            #Perform variable substitution in commandline arguments (e.g. ${KERNEL_DIR})
-
-            #This defines the substitution mapping, we can easily add more :)
-            cmdArgsSubstitution = {
-            'KERNEL_DIR':os.path.dirname(self.path) 
-            }
-
-            for index in range(0,len(self.gpuverifyCmdArgs)):
-
-                if self.gpuverifyCmdArgs[index].find('$') != -1:
-                    #We're probably going to do a substitution
-                    template=string.Template(self.gpuverifyCmdArgs[index])
-                    logging.debug('Performing command line argument substitution on:' + self.gpuverifyCmdArgs[index])
-                    self.gpuverifyCmdArgs[index]=template.substitute(cmdArgsSubstitution)
-                    logging.debug('Substitution complete, result:' + self.gpuverifyCmdArgs[index])
-
-
-            #Grab (optional regex line(s))
-            haveRegexLines=True
-            self.regex={}
-            lineCounter=3
-            while haveRegexLines:
-                line=fileObject.readline()
-                line=line[:-1] # Strip off \n
-                if line.startswith('//') and len(line) > 2:
-                    key=line[2:] #Strip //
-                    self.regex[key]=None #Use key and do not assign truth value
-                    try:
-                        re.compile(key)
-                    except re.error as e:
-                        raise KernelParseError(lineCounter,self.path,"Invalid Regex (" + str(e.__class__) + " : " + str(e) + ")")
-                else:
-                    haveRegexLines=False; #Break out of loop
+                    raise KernelParseError(1,self.path, f"\"{xfailCodeAsString}\" is not a valid error code for expected fail.")
 
-                lineCounter+=1
 
-            #Set variables to be used later
-            self.testPassed=None
-            self.returnedCode=""
-            self.gpuverifyReturnCode=""
+        #Grab command line args to pass to GPUVerify
+        #Slightly naive test
+        if not cmdArgs.startswith('//'):
+            raise KernelParseError(2,self.path,"Second Line should start with \"//\" and then optionally space seperate arguments to pass to GPUVerify")
 
-            #Finished parsing
-            logging.debug("Successfully parsed kernel \"{0}\" for test parameters".format(path))
+        self.gpuverifyCmdArgs = cmdArgs[2:].strip().split() #Split on spaces
 
-            if self.timeAsCSV:
-              self.gpuverifyCmdArgs.append("--time-as-csv=" + self.path)
+        #Perform variable substitution in commandline arguments (e.g. ${KERNEL_DIR})
 
-            #Add additional GPUVerify command line args
-            if additionalOptions != None:
-              logging.debug("Adding additional command line arguments" + str(additionalOptions))
-              self.gpuverifyCmdArgs.extend(additionalOptions)
+        #This defines the substitution mapping, we can easily add more :)
+        cmdArgsSubstitution = {
+        'KERNEL_DIR':self.kernelDir
+        }
 
+        def substituteVariable(matched):
+            if matched.group(0) == '$$':
+                return '$' # Escaped $
+            variable=matched.group(1) or matched.group(2)
+            if variable not in cmdArgsSubstitution:
+                raise KernelParseError(2,self.path,f"Unknown variable \"{variable}\" in command line arguments")
+            return cmdArgsSubstitution[variable]
 
-    def run(self):
-        """ Executes GPUVerify on this test's kernel
-            using this instance's parameters. This will set the following additional attributes on completion
-            .testPassed : Boolean
-            .returnedCode : The return code of the test (includes REGEX_MISMATCH_ERROR)
-            .gpuverifyReturnCode : GPUVerify's actual return code (doesn't include REGEX_MISMATCH_ERROR)
-        """
-        threadStr='[' + threading.currentThread().name + '] '
+        for index in range(0,len(self.gpuverifyCmdArgs)):
+
+            if self.gpuverifyCmdArgs[index].find('$') != -1:
+                #We're probably going to do a substitution
+                logging.debug('Performing command line argument substitution on:%s', self.gpuverifyCmdArgs[index])
+                self.gpuverifyCmdArgs[index]=cmdArgsVariableRegex.sub(substituteVariable, self.gpuverifyCmdArgs[index])
+                logging.debug('Substitution complete, result:%s', self.gpuverifyCmdArgs[index])
+
+
+        #Grab (optional regex line(s))
+        self.regex={}
+        self.compiledRegex={}
+        for (lineCounter, line) in enumerate(regexLines.split('\n'), 3):
+            if len(line) == 0:
+                continue # The newline ending the last regex line
+            key=line[2:] #Strip //
+            self.regex[key]=None #Use key and do not assign truth value
+            try:
+                #Allow ^ to match the beginning of multiple lines
+                self.compiledRegex[key]=re.compile(key, re.MULTILINE)
+            except re.error as e:
+                raise KernelParseError(lineCounter,self.path,f"Invalid Regex ({e.__class__} : {e})")
+
+        #Join multiple regexes into one alternation so the output only needs
+        #to be scanned once. Regexes with groups of their own are left out as
+        #their groups would be renumbered. So are regexes with inline global
+        #flags (e.g. (?i)) as before Python 3.11 these apply to the whole
+        #alternation rather than being an error.
+        self.combinedRegex=None
+        self.combinedRegexKeys=()
+        combinable=[ key for (key,matcher) in self.compiledRegex.items()
+                     if matcher.groups == 0 and matcher.flags == defaultRegexFlags ]
+        if len(combinable) > 1:
+            try:
+                self.combinedRegex=re.compile('|'.join(f'({key})' for key in combinable), re.MULTILINE)
+                self.combinedRegexKeys=tuple(combinable)
+            except re.error:
+                pass # e.g. a global flag that is only allowed at the start of a regex
 
-        cmdLine=[sys.executable, GPUVerifyExecutable] \
+        #Set variables to be used later
+        self.testPassed=None
+        self.returnedCode=""
+        self.gpuverifyReturnCode=""
+
+        #Finished parsing
+        logging.debug("Successfully parsed kernel \"%s\" for test parameters", path)
+
+        if self.timeAsCSV:
+          self.gpuverifyCmdArgs.append(f"--time-as-csv={self.path}")
+
+        #Add additional GPUVerify command line args
+        if additionalOptions != None:
+          logging.debug("Adding additional command line arguments%s", additionalOptions)
+          self.gpuverifyCmdArgs.extend(additionalOptions)
+
+        self.cmdLine=[sys.executable, GPUVerifyExecutable] \
             + self.gpuverifyCmdArgs + [self.path]
+
+    async def run(self, timeout=None):
+        """ Executes GPUVerify on this test's kernel
+            using this instance's parameters. This instance is not modified,
+            instead a GPUVerifyTestResult is returned (or None if the test was
+            killed) which should be passed to recordResult().
+
+            timeout : If not None the number of seconds after which GPUVerify is
+                      killed. The test then behaves as if GPUVerify returned TIMEOUT.
+        """
+        processInstance=None
+        timedOut=False
         try:
-            logging.info(threadStr + "Running test " + self.path)
-            logging.debug(self) # show pre test information
-
-            processInstance=subprocess.Popen(cmdLine,
-                                             stdout=subprocess.PIPE,
-                                             stderr=subprocess.PIPE,
-                                             cwd=os.path.dirname(self.path)
-                                            )
-            stdout, stderr = processInstance.communicate() #Allow program to run and wait for it to exit.
-
-        except KeyboardInterrupt:
-            logging.error("Received keyboard interrupt. Attempting to kill GPUVerify process")
-            processInstance.kill()
+            logging.info(f"Running test {self.path}")
+            logging.debug(self) # show pre test information (str(self) is only called if this is logged)
+
+            processInstance=await asyncio.create_subprocess_exec(*self.cmdLine,
+                                                                 stdout=asyncio.subprocess.PIPE,
+                                                                 stderr=asyncio.subprocess.STDOUT,
+                                                                 cwd=self.kernelDir,
+                                                                 # Put GPUVerify and the tools it runs in their own
+                                                                 # process group so they can all be killed together
+                                                                 start_new_session=(os.name == 'posix')
+                                                                )
+            # stderr is redirected to stdout so we only need to buffer a single stream
+            try:
+                #Allow program to run and wait for it to exit.
+                output, _NOT_USED = await asyncio.wait_for(processInstance.communicate(), timeout)
+            except asyncio.TimeoutError:
+                logging.error(f"Test {self.path} took longer than {timeout} seconds. Killing GPUVerify process")
+                killProcessGroup(processInstance)
+                await processInstance.wait()
+                output=b''
+                timedOut=True
+
+        except asyncio.CancelledError:
+            if processInstance != None and processInstance.returncode == None:
+                logging.error(f"Test {self.path} cancelled. Attempting to kill GPUVerify process")
+                killProcessGroup(processInstance)
+                await processInstance.wait()
             raise
 
-        # Handle byte/str issue in python 3.
-        stdout = stdout.decode()
-        stderr = stderr.decode()
+        output = output.decode()
 
         #Record the true return code of GPUVerify
-        if processInstance.returncode < 0:
+        if timedOut:
+          gpuverifyReturnCode=GPUVerifyErrorCodes.TIMEOUT
+        elif processInstance.returncode < 0:
           # Treat the test as skipped.
-          logging.error(threadStr + 'An external program killed test "'+
-                        self.path + '" with signal ' +
-                        str(-1*processInstance.returncode))
-          return
+          logging.error(f'An external program killed test "{self.path}" with signal {-1*processInstance.returncode}')
+          return None
         else:
-          self.gpuverifyReturnCode=processInstance.returncode
-          logging.debug("GPUVerify return code:" + GPUVerifyErrorCodes.errorCodeToString[self.gpuverifyReturnCode])
+          gpuverifyReturnCode=processInstance.returncode
+          logging.debug("GPUVerify return code:%s", GPUVerifyErrorCodes.codeToString(gpuverifyReturnCode))
 
         #Do Regex tests if the rest of the test went okay
-        if self.gpuverifyReturnCode == self.expectedReturnCode:
-            for regexToMatch in self.regex.keys():
-                matcher=re.compile(regexToMatch, re.MULTILINE) #Allow ^ to match the beginning of multiple lines
-                if matcher.search(stdout) == None and matcher.search(stderr) == None:
-                    self.regex[regexToMatch]=False
-                    logging.error(self.path + ": Regex \"" + regexToMatch + "\" failed to match output!")
+        regex=dict(self.regex)
+        if gpuverifyReturnCode == self.expectedReturnCode:
+            matchedRegex=set()
+            if self.combinedRegex != None:
+                for match in self.combinedRegex.finditer(output):
+                    matchedRegex.add(self.combinedRegexKeys[match.lastindex - 1])
+                    if len(matchedRegex) == len(self.combinedRegexKeys):
+                        break
+
+            for (regexToMatch, matcher) in self.compiledRegex.items():
+                #The combined scan doesn't report matches that overlap an earlier
+                #match so search individually for anything it didn't find.
+                if regexToMatch not in matchedRegex and matcher.search(output) == None:
+                    regex[regexToMatch]=False
+                    logging.error(f"{self.path}: Regex \"{regexToMatch}\" failed to match output!")
                 else:
-                    self.regex[regexToMatch]=True
-                    logging.debug(self.path + ": Regex \"" + regexToMatch + "\" matched output.")
+                    regex[regexToMatch]=True
+                    logging.debug("%s: Regex \"%s\" matched output.", self.path, regexToMatch)
 
         #Record the test return code.
-        if False in self.regex.values():
-            self.returnedCode=GPUVerifyErrorCodes.REGEX_MISMATCH_ERROR
+        if False in regex.values():
+            returnedCode=GPUVerifyErrorCodes.REGEX_MISMATCH_ERROR
         else:
-            self.returnedCode=processInstance.returncode
+            returnedCode=gpuverifyReturnCode
 
 
         #Check if the test failed overall
-        if self.returnedCode != self.expectedReturnCode :
-            self.testPassed=False
-            logging.error(threadStr + self.path + " FAILED with " + GPUVerifyErrorCodes.errorCodeToString[self.returnedCode] +
-                         " expected " + GPUVerifyErrorCodes.errorCodeToString[self.expectedReturnCode])
+        if returnedCode != self.expectedReturnCode :
+            testPassed=False
+            logging.error(f"{self.path} FAILED with {GPUVerifyErrorCodes.codeToString(returnedCode)}"
+                          f" expected {GPUVerifyErrorCodes.codeToString(self.expectedReturnCode)}")
 
             #Print output for user to see
             if logging.getLogger().getEffectiveLevel() != logging.CRITICAL:
-                for line in stderr.split('\n'):
-                    print(line)
-                for line in stdout.split('\n'):
-                    print(line)
+                print(output)
         else:
-            self.testPassed=True
-            logging.info(threadStr + self.path + " PASSED (" +
-                         ("pass" if self.expectedReturnCode == GPUVerifyErrorCodes.SUCCESS else "xfail") + ")")
+            testPassed=True
+            logging.info(f"{self.path} PASSED "
+                         f"({'pass' if self.expectedReturnCode == GPUVerifyErrorCodes.SUCCESS else 'xfail'})")
 
+        #Find the csv line for the caller to write out
+        csvLine=None
         if self.timeAsCSV:
-            #Print csv output for user to see
-            for line in stdout.split('\n'):
-                commaSplitLine = line.split(',')
-                if len(commaSplitLine) == 9:
-                    self.csvFile.write(line + '\n')
-                    self.csvFile.flush()
-                    break
-        del self.csvFile # We cannot serialise this object so we need to remove it from this class!
+            matched=csvLineRegex.search(output)
+            if matched != None:
+                csvLine=matched.group(0)
+
+        return GPUVerifyTestResult(testPassed, returnedCode, gpuverifyReturnCode, regex, csvLine)
+
+    def recordResult(self, result):
+        """ Records the GPUVerifyTestResult returned by run() on this instance.
+            This will set the following additional attributes
+            .testPassed : Boolean
+            .returnedCode : The return code of the test (includes REGEX_MISMATCH_ERROR)
+            .gpuverifyReturnCode : GPUVerify's actual return code (doesn't include REGEX_MISMATCH_ERROR)
+        """
+        self.testPassed=result.testPassed
+        self.returnedCode=result.returnedCode
+        self.gpuverifyReturnCode=result.gpuverifyReturnCode
+        self.regex=result.regex
 
         logging.debug(self) #Show after test information
 
+    def __getstate__(self):
+        """ The compiled regular expressions and command line are only
+            needed to run the test so do not store them in pickle files.
+        """
+        state=self.__dict__.copy()
+        state.pop('compiledRegex', None)
+        state.pop('combinedRegex', None)
+        state.pop('combinedRegexKeys', None)
+        state.pop('cmdLine', None)
+        return state
+
     def hasBeenExecuted(self):
         if self.testPassed == None:
             return False
@@ -288,11 +414,9 @@ class GPUVerifyTestKernel(object):
             return True
 
     def __str__(self):
-        testString="GPUVerifyTestKernel:\nFull Path:{0}\nExpected exit code:{1}\nCmdArgs: {2}\n".format(
-              self.path,
-              GPUVerifyErrorCodes.errorCodeToString[self.expectedReturnCode],
-              self.gpuverifyCmdArgs,
-          )
+        testString=(f"GPUVerifyTestKernel:\nFull Path:{self.path}\n"
+                    f"Expected exit code:{GPUVerifyErrorCodes.codeToString(self.expectedReturnCode)}\n"
+                    f"CmdArgs: {self.gpuverifyCmdArgs}\n")
 
         if self.testPassed == None:
           #Test has not yet been run
@@ -300,20 +424,20 @@ class GPUVerifyTestKernel(object):
               testString+= "No regular expressions.\n"
           else:
               for regex in self.regex.keys():
-                  testString+= "Regex:\"{0}\"\n".format(regex)
+                  testString+= f"Regex:\"{regex}\"\n"
 
           testString+= "Kernel has not yet been executed.\n"
 
         else:
           #Test has been run, show more info
           testString+= "Kernel has been executed.\n"
-          testString+= "Passed: " + str(self.testPassed) + "\n"
-          testString+= "Actual result:" + GPUVerifyErrorCodes.errorCodeToString[self.returnedCode] + "\n"
-          testString+= "GPUVerify return code:" + GPUVerifyErrorCodes.errorCodeToString[self.gpuverifyReturnCode] + "\n"
+          testString+= f"Passed: {self.testPassed}\n"
+          testString+= f"Actual result:{GPUVerifyErrorCodes.codeToString(self.returnedCode)}\n"
+          testString+= f"GPUVerify return code:{GPUVerifyErrorCodes.codeToString(self.gpuverifyReturnCode)}\n"
           if len(self.regex) > 0:
               testString+= "Regular expression matching:\n"
               for (regex,succeeded) in self.regex.items():
-                  testString+= "\"" + regex +"\" : " + ("MATCHED" if succeeded else "FAILED TO MATCH") + "\n"
+                  testString+= f"\"{regex}\" : {'MATCHED' if succeeded else 'FAILED TO MATCH'}\n"
           else:
               testString+="No regular expressions.\n"
 
@@ -330,7 +454,7 @@ class KernelParseError(GPUVerifyTesterError):
         self.message=message
 
     def __str__(self):
-        return "KernelParseError : Line " + str(self.lineNumber) + " in \"" + self.fileName + "\": " + self.message
+        return f"KernelParseError : Line {self.lineNumber} in \"{self.fileName}\": {self.message}"
 
 class CanonicalisationError(GPUVerifyTesterError):
 
@@ -339,7 +463,7 @@ class CanonicalisationError(GPUVerifyTesterError):
         self.prefix=prefix
 
     def __str__(self):
-        return "CanonicalisationError : Cannot construct a canonical path from \"" + self.path + "\" using prefix \"" + self.prefix + "\""
+        return f"CanonicalisationError : Cannot construct a canonical path from \"{self.path}\" using prefix \"{self.prefix}\""
 
 #This Action will be triggered from the command line
 class PrintXfailCodes(argparse.Action):
@@ -349,35 +473,25 @@ class PrintXfailCodes(argparse.Action):
 
             sys.exit(GPUVerifyTesterErrorCodes.SUCCESS)
 
-def getPickleOptions():
-    """ Returns a dictionary of named options to
-        use with pickle commands
-    """
-    extraOptions = {}
-    if sys.version_info.major > 2:
-        # Make Python 3 try to produce pickle files readable in python 2
-        extraOptions['fix_imports'] = True
-    return extraOptions
-
 def openPickle(path):
     try:
         with open(path,"rb") as inputFile:
-            return pickle.load(inputFile, **getPickleOptions())
+            return pickle.load(inputFile)
     except IOError:
-        logging.error("Failed to open pickle file \"" + path + "\"")
+        logging.error(f"Failed to open pickle file \"{path}\"")
         sys.exit(GPUVerifyTesterErrorCodes.FILE_OPEN_ERROR)
     except pickle.UnpicklingError:
-        logging.error("Failed to parse pickle file \" + path + \"")
+        logging.error(f"Failed to parse pickle file \"{path}\"")
         sys.exit(GPUVerifyTesterErrorCodes.FILE_OPEN_ERROR)
 
 def dumpTestResults(tests,prefix):
     try:
         summariseTests(tests)
-        print("Printing results of " + str(len(tests)) + " tests")
+        print(f"Printing results of {len(tests)} tests")
         for testObj in tests:
-            print("\n" + ("#" * printBarWidth)) #Header bar
+            print("\n" + "#" * printBarWidth) #Header bar
             try:
-                print("Test:" + getCanonicalTestName(testObj.path, prefix))
+                print(f"Test:{getCanonicalTestName(testObj.path, prefix)}")
             except CanonicalisationError as e:
                 logging.error(e)
                 print("Test: No canonical name")
@@ -403,14 +517,13 @@ class comparePickleFiles(argparse.Action):
         # Check pickle files exist
         for pFile in [ values[0], values[1]]:
             if not os.path.exists(pFile):
-                logging.error("'{0}' does not exist.".format(pFile))
+                logging.error(f"'{pFile}' does not exist.")
                 sys.exit(GPUVerifyTesterErrorCodes.FILE_OPEN_ERROR)
 
         # First argument should be older set of tests than second argument.
         if os.path.getmtime(values[0]) > os.path.getmtime(values[1]):
-            logging.error( ("'{0}' is newer than '{1}'.\nYou probably specified the arguments the wrong way round." +
-                           "\nIf you really want to perform the comparision this way round run `touch {1}` first.").format(
-                            values[0], values[1]))
+            logging.error(f"'{values[0]}' is newer than '{values[1]}'.\nYou probably specified the arguments the wrong way round."
+                          f"\nIf you really want to perform the comparision this way round run `touch {values[1]}` first.")
             sys.exit(GPUVerifyTesterErrorCodes.GENERAL_ERROR)
 
         result = doComparison(openPickle(values[0]),values[0],openPickle(values[1]),values[1],namespace.canonical_path_prefix)
@@ -440,7 +553,7 @@ def getCanonicalTestName(path,prefix):
 def doComparison(oldTestList,oldTestName,newTestList,newTestName, canonicalPathPrefix):
     #Perform Comparison
 
-    logging.info("Performing comparison of \"" + newTestName +  "\" run and the run recorded in \"" + oldTestName + "\"")
+    logging.info(f"Performing comparison of \"{newTestName}\" run and the run recorded in \"{oldTestName}\"")
     changedTestCounter=0
     missingTestCounter=0
     newTestCounter=0
@@ -463,73 +576,78 @@ def doComparison(oldTestList,oldTestName,newTestList,newTestName, canonicalPathP
 
             testDictionary[cPath]=test #Add entry
 
-    logging.info("\"" + oldTestName + "\" has " + str(len(oldTestDic)) + " test(s)")
-    logging.info("\"" + newTestName + "\" has " + str(len(newTestDic)) + " test(s)")
+    logging.info(f"\"{oldTestName}\" has {len(oldTestDic)} test(s)")
+    logging.info(f"\"{newTestName}\" has {len(newTestDic)} test(s)")
+
+    oldTestPaths=set(oldTestDic)
+    newTestPaths=set(newTestDic)
 
-    #Iterate over old tests
+    #Iterate over tests common to both test sets
     changeIsWorse = False
-    for (cPath, oldTest) in oldTestDic.items():
-        if cPath in newTestDic:
-            #Found a test common to both test sets
-
-            #Look for a change in result
-            newTest = newTestDic[cPath]
-            if oldTest.testPassed != newTest.testPassed:
-                logging.warning('#'*printBarWidth)
-                logging.warning("Test \"" + cPath + "\" result has changed.\n" +
-                                "Test \"" + cPath + "\" from \"" + oldTestName + "\":\n\n" +
-                                str(oldTest) + '\n' +
-                                "Test \"" + cPath + "\" from \"" + newTestName + "\"\n" +
-                                str(newTest))
-                changedTestCounter+=1
-                # change is for the worse
-                if oldTest.testPassed:
-                    changeIsWorse = True
-        else:
-            logging.warning("Test \"" + cPath + "\" present in \"" + oldTestName+ "\" was missing from \"" + newTestName + "\"")
-            missingTestCounter+=1
-            changeIsWorse = True
+    for cPath in sorted(oldTestPaths & newTestPaths):
+        #Look for a change in result
+        oldTest = oldTestDic[cPath]
+        newTest = newTestDic[cPath]
+        if oldTest.testPassed != newTest.testPassed:
+            logging.warning('#'*printBarWidth)
+            logging.warning(f"Test \"{cPath}\" result has changed.\n"
+                            f"Test \"{cPath}\" from \"{oldTestName}\":\n\n"
+                            f"{oldTest}\n"
+                            f"Test \"{cPath}\" from \"{newTestName}\"\n"
+                            f"{newTest}")
+            changedTestCounter+=1
+            # change is for the worse
+            if oldTest.testPassed:
+                changeIsWorse = True
+
+    #Iterate over old tests that were not just completed
+    for cPath in sorted(oldTestPaths - newTestPaths):
+        logging.warning(f"Test \"{cPath}\" present in \"{oldTestName}\" was missing from \"{newTestName}\"")
+        missingTestCounter+=1
+        changeIsWorse = True
 
     logging.info('#'*printBarWidth + '\n')
     #Iterate over just completed tests to notify about newly introduced tests.
-    for cPath in newTestDic.keys():
-        if cPath not in oldTestDic:
-            logging.warning("Test \"" + cPath + "\" was executed in \"" + newTestName + "\" but was not present in \"" + oldTestName + "\"" )
-            newTestCounter+=1
+    for cPath in sorted(newTestPaths - oldTestPaths):
+        logging.warning(f"Test \"{cPath}\" was executed in \"{newTestName}\" but was not present in \"{oldTestName}\"")
+        newTestCounter+=1
 
     logging.info('#'*printBarWidth + '\n')
     #Print test summary
-    logging.info("Summary:\n" +
-                 "# of changed tests:" + str(changedTestCounter) + '\n' +
-                 "# of missing tests:" + str(missingTestCounter) + '\n' +
-                 "The above is number of tests in \"" + oldTestName + "\" that aren't present in \"" + newTestName + "\"\n" +
-                 "# of new tests:" + str(newTestCounter) + '\n' +
-                 "The above is number of tests in \"" + newTestName + "\" that aren't present in \"" + oldTestName + "\"")
+    logging.info("Summary:\n"
+                 f"# of changed tests:{changedTestCounter}\n"
+                 f"# of missing tests:{missingTestCounter}\n"
+                 f"The above is number of tests in \"{oldTestName}\" that aren't present in \"{newTestName}\"\n"
+                 f"# of new tests:{newTestCounter}\n"
+                 f"The above is number of tests in \"{newTestName}\" that aren't present in \"{oldTestName}\"")
 
     if changeIsWorse:
         if newTestCounter != 0 or missingTestCounter != 0: 
             # If new tests have been added or some tests are missing
             # and some tests have failed then the is not really 
             # any ordering
-            logging.info(oldTestName + " != " + newTestName)
+            logging.info(f"{oldTestName} != {newTestName}")
         else:
-            logging.info(oldTestName + " > " + newTestName)
+            logging.info(f"{oldTestName} > {newTestName}")
         return 1
     elif changedTestCounter == 0 and missingTestCounter == 0 and newTestCounter == 0:
-        logging.info(oldTestName + " = " + newTestName)
+        logging.info(f"{oldTestName} = {newTestName}")
         return 0
     else:
         # Adding tests is fine.
-        logging.info(oldTestName + " < " + newTestName)
+        logging.info(f"{oldTestName} < {newTestName}")
         return -1
 
-def summariseTests(tests):
+TestOutcomeCounts=namedtuple('TestOutcomeCounts', ['OpenCL', 'CUDA', 'passed', 'failed', 'xfailed', 'skipped'])
+
+def countTestOutcomes(tests):
     """
-        Iterates through a list of GPUVerifyTestKernel objects and prints out a summary
+        Iterates through a list of GPUVerifyTestKernel objects once and
+        returns the TestOutcomeCounts for them
     """
+    SUCCESS=GPUVerifyErrorCodes.SUCCESS # Avoid looking this up for every test
 
     OpenCLCounter=0
-    CUDACounter=0
     passCounter=0
     failCounter=0
     xfailCounter=0
@@ -537,104 +655,103 @@ def summariseTests(tests):
 
     for test in tests:
         #Record kernel type
-        if test.path.endswith('cl'):
+        if test.path[-2:] == 'cl':
             OpenCLCounter += 1
-        else:
-            CUDACounter += 1
 
-        if test.hasBeenExecuted():
-            #Record if test was pass/fail/xfail
-            if test.testPassed:
-                if test.returnedCode == GPUVerifyErrorCodes.SUCCESS:
-                    passCounter += 1
-                else:
-                    xfailCounter += 1
+        #Record if test was pass/fail/xfail
+        testPassed=test.testPassed
+        if testPassed == None:
+            skipCounter += 1
+        elif testPassed:
+            if test.returnedCode == SUCCESS:
+                passCounter += 1
             else:
-                failCounter += 1
+                xfailCounter += 1
         else:
-            skipCounter += 1
+            failCounter += 1
+
+    return TestOutcomeCounts(OpenCLCounter, len(tests) - OpenCLCounter,
+                             passCounter, failCounter, xfailCounter, skipCounter)
+
+def summariseTests(tests):
+    """
+        Iterates through a list of GPUVerifyTestKernel objects and prints out a summary
+    """
+    counts=countTestOutcomes(tests)
 
     #Print output
     print('#'*printBarWidth)
     print('')
     print('Summary:')
-    print('# of tests:{0}'.format(len(tests)))
-    print('# OpenCL kernels:{0}'.format(OpenCLCounter))
-    print('# CUDA kernels:{0}'.format(CUDACounter))
-    print('# of passes:{0}'.format(passCounter))
-    print('# of expected failures (xfail):{0}'.format(xfailCounter))
-    print('# of unexpected failures:{0}'.format(failCounter))
-    print('# of tests skipped:{0}'.format(skipCounter))
+    print(f'# of tests:{len(tests)}')
+    print(f'# OpenCL kernels:{counts.OpenCL}')
+    print(f'# CUDA kernels:{counts.CUDA}')
+    print(f'# of passes:{counts.passed}')
+    print(f'# of expected failures (xfail):{counts.xfailed}')
+    print(f'# of unexpected failures:{counts.failed}')
+    print(f'# of tests skipped:{counts.skipped}')
     print('')
     print('#'*printBarWidth)
 
-class Worker(threading.Thread):
-    def __init__(self,threadPool):
-        threading.Thread.__init__(self)
-        self.threadPool = threadPool
+def findTestFiles(path, matcher):
+    """ Recursively yields the os.DirEntry of every file under path
+        whose name matches the compiled regex matcher. Like os.walk()
+        symbolic links to directories are not followed.
+    """
+    try:
+        with os.scandir(path) as iterator:
+            entries=list(iterator)
+    except OSError:
+        return # Ignore unreadable directories like os.walk() does
+
+    for entry in entries:
+        if entry.is_dir():
+            if not entry.is_symlink():
+                yield from findTestFiles(entry.path, matcher)
+        elif matcher.match(entry.name) != None:
+            yield entry
+
+def parseKernel(kernelPath, timeAsCSV, additionalOptions):
+    """ Returns the GPUVerifyTestKernel for kernelPath or the
+        KernelParseError raised whilst trying to parse it.
+    """
+    try:
+        return GPUVerifyTestKernel(kernelPath, timeAsCSV, additionalOptions)
+    except KernelParseError as e:
+        return e
+
+async def runTests(tests, maxRunningTests, stopOnFail, csvFile, timeout=None):
+    """ Runs the tests with at most maxRunningTests GPUVerify processes
+        running at once. Results are recorded on the tests as they complete.
+        See GPUVerifyTestKernel.run() for the meaning of timeout.
+    """
+    runningTestsLimit=asyncio.Semaphore(maxRunningTests)
+
+    async def runTest(test):
+        async with runningTestsLimit:
+            return (test, await test.run(timeout))
+
+    pendingTests=[ asyncio.ensure_future(runTest(test)) for test in tests ]
+    try:
+        for completedTest in asyncio.as_completed(pendingTests):
+            (test, result) = await completedTest
+            if result == None:
+                continue # Test was killed so treat it as skipped
 
-        #We will be abruptly killed in main thread exits
-        self.daemon = True
+            test.recordResult(result)
 
-    def run(self):
-        while True:
-            test=self.threadPool.theQueue.get(block=True,timeout=None)
-            test.run()
+            if result.csvLine != None:
+                csvFile.write(result.csvLine + '\n')
+                csvFile.flush()
 
-            if not test.testPassed and self.threadPool.stopOnFail:
-                # Try to stop everything!
+            if not test.testPassed and stopOnFail:
                 logging.info('Trying to stop on first failure')
-                self.threadPool.halt()
-
-            #Notify the Queue that we finished our task
-            self.threadPool.theQueue.task_done()
-
-class ThreadPool:
-    def __init__(self, numberOfThreads, stopOnFail=False):
-        self.theQueue = Queue(0);
-        self.stopOnFail = stopOnFail
-
-        #Create the Threads
-        self.threads= []
-        for tid in range(numberOfThreads):
-            self.threads.append( Worker(self) )
-
-    def addTest(self, test):
-        self.theQueue.put(test)
-
-    def start(self):
-        for tid in self.threads:
-            tid.start()
-
-    def waitForCompletion(self):
-      """ This will wait for the queue to empty.
-          We use a polling wait because Queue.join()
-          blocks until queue is empty, even if we get
-          sent signals like SIGTERM (i.e. We can't
-          catch KeyboardInterrupt at the right time)
-
-      """
-      try:
-        # WARNING: unfinished_tasks is not part of public API
-        # so this might break in future. Cannot use Queue.empty()
-        # because that will return true before threads complete
-        while self.theQueue.unfinished_tasks > 0:
-          time.sleep(0.5)
-      except KeyboardInterrupt:
-        logging.error("Received keyboard interrupt. Clearing queue!")
-        self.halt()
-        raise
-
-    def halt(self):
-        """
-            Try to halt the thread pool
-        """
-        while not self.theQueue.empty():
-          try:
-            self.theQueue.get()
-            self.theQueue.task_done()
-          except Queue.Empty:
-            break #Handle potential race where the queue becomes empty whilst executing try block
+                break
+    finally:
+        # Kill any tests that are still running
+        for pendingTest in pendingTests:
+            pendingTest.cancel()
+        await asyncio.gather(*pendingTests, return_exceptions=True)
 
 def main(arg):
     global GPUVerifyExecutable
@@ -664,6 +781,7 @@ def main(arg):
     parser.add_argument("--time-as-csv", action="store_true", default=False, help="Print timing of each test as CSV")
     parser.add_argument("--csv-file", type=str, default=None, help="Write timing data to a file (Note: requires --time-as-csv to be enabled)")
     parser.add_argument("--stop-on-fail", action="store_true", default=False, help="Stop on first failure")
+    parser.add_argument("--test-timeout", type=int, default=0, help="Kill GPUVerify if a test takes longer than this many seconds and treat the test as returning TIMEOUT. 0 means no timeout (default: %(default)s)")
     parser.add_argument("--shuffle", type=int, default=None, help="Permute the order of tests under evaluation")
     parser.add_argument("--force-gpuverify-script", type=str, default=None, help="Force a different GPUVerify script to be used")
 
@@ -680,7 +798,7 @@ def main(arg):
 
     if args.force_gpuverify_script != None:
         GPUVerifyExecutable = args.force_gpuverify_script
-        logging.info('Forcing GPUVerify script to be {}'.format(GPUVerifyExecutable))
+        logging.info(f'Forcing GPUVerify script to be {GPUVerifyExecutable}')
 
     #Check the user isn't trying something silly
     if(args.write_pickle == args.compare_run and len(args.write_pickle) > 0):
@@ -699,7 +817,7 @@ def main(arg):
     recursionRootPath=os.path.abspath(args.directory)
 
     if not os.path.isdir(recursionRootPath):
-        logging.error("\"{}\" does not refer an existing directory".format(recursionRootPath))
+        logging.error(f"\"{recursionRootPath}\" does not refer an existing directory")
         return GPUVerifyTesterErrorCodes.FILE_SEARCH_ERROR
 
     cudaCount=0
@@ -721,27 +839,26 @@ def main(arg):
           elif kernel.endswith('misc'):
               miscCount+=1
           else:
-            logging.debug("Not a valid kernel:\"{}\"".format(kernel))
+            logging.debug("Not a valid kernel:\"%s\"", kernel)
             return GPUVerifyErrorCodes.FILE_SEARCH_ERROR
           kernelFiles.append(os.path.join(recursionRootPath,kernel))
 
     else:
       matcher=re.compile(args.test_filename_regex)
-      logging.debug("Recursing {}".format(recursionRootPath))
-      for(root,dirs,files) in os.walk(recursionRootPath):
-          for f in files:
-              if(matcher.match(f) != None):
-                  if f.endswith('cu'):
-                      cudaCount+=1
-                      logging.debug("Found CUDA kernel:\"{}\"".format(f))
-                  if f.endswith('cl'):
-                      openCLCount+=1
-                      logging.debug("Found OpenCL kernel:\"{}\"".format(f))
-                  if f.endswith('misc'):
-                      miscCount+=1
-                      logging.debug("Found miscellaneous test:\"{}\"".format(f))
-
-                  kernelFiles.append(os.path.join(root,f))
+      logging.debug("Recursing %s", recursionRootPath)
+      for entry in findTestFiles(recursionRootPath, matcher):
+          f=entry.name
+          if f.endswith('cu'):
+              cudaCount+=1
+              logging.debug("Found CUDA kernel:\"%s\"", f)
+          if f.endswith('cl'):
+              openCLCount+=1
+              logging.debug("Found OpenCL kernel:\"%s\"", f)
+          if f.endswith('misc'):
+              miscCount+=1
+              logging.debug("Found miscellaneous test:\"%s\"", f)
+
+          kernelFiles.append(entry.path)
 
     cudaCountIgnored=0
     openCLCountIgnored=0
@@ -758,16 +875,16 @@ def main(arg):
           elif kernel.endswith('misc'):
             miscCountIgnored+=1
           else:
-            logging.debug("Not a valid kernel:\"{}\"".format(kernel))
+            logging.debug("Not a valid kernel:\"%s\"", kernel)
             return GPUVerifyErrorCodes.FILE_SEARCH_ERROR
           kernelFilesIgnored.append(os.path.join(recursionRootPath,kernel))
         kernelFiles = list(set(kernelFiles) - set(kernelFilesIgnored))
 
-      logging.info("Found    {0} OpenCL kernels, {1} CUDA kernels and {2} miscellaneous tests".format(openCLCount,cudaCount,miscCount))
-      logging.info("Ignoring {0} OpenCL kernels, {1} CUDA kernels and {2} miscellaneous tests".format(openCLCountIgnored,cudaCountIgnored,miscCountIgnored))
-      logging.info("Running  {0} OpenCL kernels, {1} CUDA kernels and {2} miscellaneous tests".format(openCLCount-openCLCountIgnored,cudaCount-cudaCountIgnored,miscCount-miscCountIgnored))
+      logging.info(f"Found    {openCLCount} OpenCL kernels, {cudaCount} CUDA kernels and {miscCount} miscellaneous tests")
+      logging.info(f"Ignoring {openCLCountIgnored} OpenCL kernels, {cudaCountIgnored} CUDA kernels and {miscCountIgnored} miscellaneous tests")
+      logging.info(f"Running  {openCLCount-openCLCountIgnored} OpenCL kernels, {cudaCount-cudaCountIgnored} CUDA kernels and {miscCount-miscCountIgnored} miscellaneous tests")
     else:
-      logging.info("Found {0} OpenCL kernels, {1} CUDA kernels and {2} miscellaneous tests".format(openCLCount,cudaCount,miscCount))
+      logging.info(f"Found {openCLCount} OpenCL kernels, {cudaCount} CUDA kernels and {miscCount} miscellaneous tests")
 
     if len(kernelFiles) == 0:
         logging.error("Could not find any OpenCL, CUDA kernels or miscellaneous tests")
@@ -777,17 +894,25 @@ def main(arg):
     kernelFiles.sort()
     tests=[]
     csvFile = open(args.csv_file,"w") if args.csv_file else sys.stdout
-    for kernelPath in kernelFiles:
-        try:
-            tests.append(GPUVerifyTestKernel(kernelPath, args.time_as_csv, csvFile, getattr(args,'gvopt=') ))
-        except KernelParseError as e:
-            logging.error(e)
+
+    #Parsing is I/O bound so read the kernels using a pool of threads
+    parsePool = ThreadPool(min(32, 4*multiprocessing.cpu_count()))
+    try:
+        parsedKernels = parsePool.map(lambda kernelPath: parseKernel(kernelPath, args.time_as_csv, getattr(args,'gvopt=')),
+                                      kernelFiles)
+    finally:
+        parsePool.close()
+
+    for parsedKernel in parsedKernels:
+        if isinstance(parsedKernel, KernelParseError):
+            logging.error(parsedKernel)
             if args.stop_on_fail:
                 return GPUVerifyTesterErrorCodes.KERNEL_PARSE_ERROR
+        else:
+            tests.append(parsedKernel)
 
     #run tests
-    logging.info("Using " + str(args.threads) + " threads")
-    threadPool = ThreadPool(args.threads, args.stop_on_fail)
+    logging.info(f"Running at most {args.threads} tests in parallel")
 
     logging.info("Running tests...")
 
@@ -795,22 +920,20 @@ def main(arg):
         print("kernel,status,clang,opt,bugle,vcgen,cruncher,boogiedriver,total", file=csvFile)
 
     start = time.time()
-    for test in tests:
-        if args.run_only_pass and test.expectedReturnCode != GPUVerifyErrorCodes.SUCCESS :
-            logging.warning("Skipping xfail test:{0}".format(test.path))
-            continue
-
-        if args.run_only_xfail and test.expectedReturnCode == GPUVerifyErrorCodes.SUCCESS :
-            logging.warning("Skipping pass test:{0}".format(test.path))
-            continue
-
-        threadPool.addTest(test)
+    testsToRun=[ test for test in tests
+                 if not (args.run_only_pass and test.expectedReturnCode != GPUVerifyErrorCodes.SUCCESS)
+                 and not (args.run_only_xfail and test.expectedReturnCode == GPUVerifyErrorCodes.SUCCESS) ]
+    if len(testsToRun) != len(tests):
+        logging.info("Skipping %d filtered tests", len(tests) - len(testsToRun))
 
     #Start tests
-    threadPool.start()
     try:
-      threadPool.waitForCompletion()
+      # On a keyboard interrupt asyncio.run() cancels the
+      # running tests which kills their GPUVerify processes
+      asyncio.run(runTests(testsToRun, args.threads, args.stop_on_fail, csvFile,
+                           args.test_timeout if args.test_timeout > 0 else None))
     except KeyboardInterrupt:
+      logging.error("Received keyboard interrupt. Stopped running tests!")
       sys.exit(GPUVerifyTesterErrorCodes.GENERAL_ERROR)
 
     end = time.time()
@@ -820,15 +943,15 @@ def main(arg):
       summariseTests(tests)
 
     if len(args.write_pickle) > 0 :
-        logging.info("Writing run information to pickle file \"" + args.write_pickle + "\"")
+        logging.info(f"Writing run information to pickle file \"{args.write_pickle}\"")
         with open(args.write_pickle,"wb") as output:
-            pickle.dump(tests, output, protocol=2, **getPickleOptions())
+            pickle.dump(tests, output, protocol=4)
 
     if oldTests!=None:
         doComparison(oldTests,args.compare_run,tests,"Newly completed tests", args.canonical_path_prefix)
 
     if logging.getLogger().getEffectiveLevel() != logging.CRITICAL:
-        print("Time taken to run tests: " + str((end - start)) )
+        print(f"Time taken to run tests: {end - start}")
 
     return GPUVerifyTesterErrorCodes.SUCCESS
 
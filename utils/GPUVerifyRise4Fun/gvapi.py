@@ -10,14 +10,20 @@ import tempfile
 import shutil
 import re
 import logging
-import traceback
+import hashlib
+import collections
+import atexit
+import weakref
+import signal
+import threading
+import Queue
 
 #Internal logger
 _logging = logging.getLogger(__name__)
 
 # Put GPUVerify.py module in search path
 sys.path.insert(0, config.GPUVERIFY_ROOT_DIR)
-from GPUVerify import ErrorCodes
+from GPUVerify import ErrorCodes, Tools
 
 # Error code to message map
 helpMessage = {
@@ -32,6 +38,78 @@ ErrorCodes.TIMEOUT:"Verification timed out.",
 ErrorCodes.CONFIGURATION_ERROR:"The web service has been incorrectly configured. Please report this issue to gpuverify-support@googlegroups.com"
 }
 
+# A whitelist of allowed command line options.
+# The options most requests use come first as they are tried in order.
+safeOptions=[
+             # OpenCL NDRange arguments
+             r'--local_size=(\d+|\[\d+(,\d+){0,2}\])',
+             r'--num_groups=(\d+|\[\d+(,\d+){0,2}\])',
+             r'--global_size=(\d+|\[\d+(,\d+){0,2}\])',
+             # CUDA grid arguments
+             r'--blockDim=(\d+|\[\d+(,\d+){0,2}\])',
+             r'--gridDim=(\d+|\[\d+(,\d+){0,2}\])',
+             '--findbugs',
+             r'--loop-unwind=\d+',
+             '--verify',
+             '--adversarial-abstraction',
+             '--array-equalities',
+             '--asymmetric-asserts',
+             r'--atomic=(r|rw|none)',
+             # '--debug', # developer option, should not be visible
+             #'--dynamic-analysis', # Note sure if safe, disable for now
+             '--equality-abstraction',
+             '--math-int',
+             '--no-annotations',
+             '--no-barrier-access-checks',
+             '--no-benign',
+             '--no-constant-write-checks',
+             '--no-infer',
+             '--no-loop-predicate-invariants',
+             '--no-refinded-atomics',
+             # '--no-smart-predication', # Most likely broken, disable
+             '--no-uniformity-analysis',
+             '--only-divergence',
+             '--only-intra-group',
+             '--only-requires',
+             # '--parallel-inference', # Might bog down machine completely
+             '--time',
+             '--staged-inference',
+             # r'--scheduling=[a-z-]+', # Not sure if safe
+             # '--verbose', # developer option, should not be visible
+             r'--warp-sync=\d{1,3}'
+            ]
+
+# The whitelist compiled once as a single alternation so that each
+# command line option is checked with one match. \Z rather than $ is used
+# so that the whole option must match (there is no re.fullmatch in Python 2).
+_safeOptionsRegex = re.compile(r'(?:' + '|'.join(r'(?:' + option + r')' for option in safeOptions) + r')\Z')
+
+# GPUVerify's --timeout applies to each tool it runs (not to the whole run) so
+# GPUVerify (and all of its tools) is only killed once every tool could have
+# used its full timeout plus this many seconds. This only guards against
+# GPUVerify hanging, it is not a tighter timeout.
+_timeoutGracePeriod = 5
+
+# The maximum number of notifications (completed commands or lines of output)
+# waiting to be passed to observers. Once reached running a command blocks
+# until observers catch up.
+_observerQueueSize = 64
+
+# Matches the lines of `GPUVerify.py --version` that identify the version.
+# These can appear in any order so they are found in a single pass using
+# finditer() with one named group per line of interest.
+_versionRegex = re.compile(r'local-revision\s+:\s+(?P<localID>\d+)|vcgen\s+:\s+(?P<changesetID>[a-z0-9]+)')
+
+class UnsafeOptionError(Exception):
+  """
+      Raised by GPUVerifyTool.filterCmdArgs() in strict mode when a command
+      line option is not in the whitelist.
+      option : The rejected command line option
+  """
+  def __init__(self, option):
+    Exception.__init__(self, 'Command line option "' + option + '" is not allowed')
+    self.option = option
+
 # Observer design pattern
 class GPUVerifyObserver(object):
   """
@@ -39,22 +117,66 @@ class GPUVerifyObserver(object):
       source     : The input source code as a string
       args       : List of command line options
       returnCode : The return code given by GPUVerify
-      output     : The output of the GPUVerify Tool
+      output     : The output of the GPUVerify Tool as an undecoded byte string (str)
   """
   def receive(self, source, args, returnCode, output):
     pass
 
+  def receiveChunk(self, line):
+    """
+        Receive a line of output from a GPUVerify command as it is read while
+        the command is running. Lines are received in order and before
+        receive() is called for the completed command. This is not called if
+        the result of the command was cached.
+        Like receive() this is called on the tool's observer thread so it is
+        never called at the same time as receive().
+        line       : A line of output from the GPUVerify Tool as an undecoded byte string (str)
+    """
+    pass
+
+# Maps a weak reference to each GPUVerifyTool to its list of idle working
+# directories. Weak references are used so that a tool that is no longer used
+# (e.g. one only made to call getVersionString()) has its working directories
+# removed when it is garbage collected rather than at exit.
+_toolWorkingDirs = { }
+
+def _removeWorkingDirs(workingDirs):
+  while workingDirs:
+    workingDir = workingDirs.pop()
+    try:
+      os.rmdir(workingDir) # Idle working directories are empty
+    except OSError:
+      shutil.rmtree(workingDir, ignore_errors=True)
+
+def _toolCollected(toolRef):
+  _removeWorkingDirs(_toolWorkingDirs.pop(toolRef))
+
+@atexit.register
+def _closeTools():
+  for (toolRef, workingDirs) in _toolWorkingDirs.items():
+    tool = toolRef()
+    if tool:
+      tool.close()
+    _removeWorkingDirs(workingDirs)
+
 class GPUVerifyTool(object):
   """
       rootPath : Is the root directory of the GPUVerify tool ( development or deploy)
-      tempDir  : Is the directory to use for temporary files. If None set then use system default.
+      tempDir  : Is the directory to use for temporary files. If None set then use /dev/shm if
+                 available (so that kernels and intermediate files are kept in memory) otherwise
+                 use system default.
+      cacheSize : The maximum number of verification results to remember. If the same kernel
+                  is submitted again with the same arguments then the remembered result is
+                  returned instead of running GPUVerify again. 0 disables the cache.
   """
-  def __init__(self, rootPath, tempDir=None):
+  def __init__(self, rootPath, tempDir=None, cacheSize=512):
     rootPath = os.path.abspath(rootPath)
     if tempDir:
       self.tempDir = os.path.abspath(tempDir)
-      if not os.path.exists(tempDir):
+      if not os.path.exists(self.tempDir):
         raise Exception('Path to temporary directory must exist')
+    elif os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+      self.tempDir = '/dev/shm'
     else:
       self.tempDir = None
 
@@ -65,8 +187,57 @@ class GPUVerifyTool(object):
     if not os.path.exists(self.toolPath):
       raise Exception('Could not find GPUVerify at "' + self.toolPath + '"')
 
+    # The paths were checked above so they are not checked again for each run
+    self.__argvPrefix = ( sys.executable, self.toolPath )
+
     self.observers = [ ]
 
+    # The bound receive() and receiveChunk() methods of the observers so that
+    # notifying them doesn't need to look the methods up every time.
+    # Observers that don't override receiveChunk() are left out of
+    # self.__chunkReceivers so output is only streamed when it is wanted.
+    self.__receivers = [ ]
+    self.__chunkReceivers = [ ]
+
+    # Results are not tied to a GPUVerify version as the version is only read
+    # at start up (see meta_data.py) so the server must be restarted anyway
+    # when GPUVerify is updated.
+    self.cacheSize = cacheSize
+    self.__cache = collections.OrderedDict() # Least recently used first
+
+    self.__version = None # Set by getVersionString()
+
+    # Working directories not currently in use by a GPUVerify process.
+    # These are emptied and reused rather than being made for every run.
+    self.__idleWorkingDirs = [ ]
+
+    # Observers are notified of output and completed commands on a single
+    # separate thread so that a slow observer doesn't delay returning the
+    # result and observers are never called concurrently. The thread is
+    # started when first needed (i.e. after the web server has forked).
+    self.__observerQueue = Queue.Queue(_observerQueueSize)
+    self.__observerThread = None
+    self.__observerThreadLock = threading.Lock() # Guards starting and stopping the observer thread
+
+    _toolWorkingDirs[weakref.ref(self, _toolCollected)] = self.__idleWorkingDirs
+
+  def close(self):
+    """
+        Wait for observers to be notified of all completed commands and
+        remove temporary working directories. This is called automatically
+        at exit for tools that are still in use.
+    """
+    with self.__observerThreadLock:
+      observerThread = self.__observerThread
+      if observerThread:
+        self.__observerQueue.put(None)
+        self.__observerThread = None
+
+    if observerThread:
+      observerThread.join()
+
+    _removeWorkingDirs(self.__idleWorkingDirs)
+
   def registerObserver(self, observer):
     """
         Register an observer (of type GPUVerifyObserver) that will receive notifications
@@ -77,8 +248,11 @@ class GPUVerifyTool(object):
       raise Exception("Invalid observer")
     else:
       self.observers.append(observer)
+      self.__receivers.append(observer.receive)
+      if observer.receiveChunk.__func__ is not GPUVerifyObserver.receiveChunk.__func__:
+        self.__chunkReceivers.append(observer.receiveChunk)
 
-  def filterCmdArgs(self, source, args, ignoredArgs=None, additionalArgs=None):
+  def filterCmdArgs(self, source, args, ignoredArgs=None, additionalArgs=None, strict=False):
     """
       Extract command line arguments from the first line of the source code
       that are allowed and filter them. The intention is that `args` will be
@@ -91,11 +265,14 @@ class GPUVerifyTool(object):
       additionalArgs : If not None this list be used as additional command line
                        arguments. Just like the arguments in the source code these
                        will be filtered.
+      strict : If True raise UnsafeOptionError on the first argument that is not
+               allowed instead of ignoring it.
     """
     if len(args) != 0:
       raise Exception("Argument list must be empty")
 
-    firstLine=source.splitlines()[0]
+    # Only take the first line, allowing for \n, \r\n and \r line endings
+    firstLine=re.match(r'[^\r\n]*', source).group(0)
 
     if not firstLine.startswith('//'):
       raise Exception('First line of source must have // style comment')
@@ -105,56 +282,15 @@ class GPUVerifyTool(object):
     if additionalArgs:
         foundArgs.extend(additionalArgs)
 
-    #A whitelist of allowed options
-    safeOptions=['--adversarial-abstraction',
-                 '--array-equalities',
-                 '--asymmetric-asserts',
-                 r'--atomic=(r|rw|none)',
-                 # '--debug', # developer option, should not be visible
-                 #'--dynamic-analysis', # Note sure if safe, disable for now
-                 '--equality-abstraction',
-                 '--findbugs',
-                 r'--loop-unwind=\d+',
-                 '--math-int',
-                 '--no-annotations',
-                 '--no-barrier-access-checks',
-                 '--no-benign',
-                 '--no-constant-write-checks',
-                 '--no-infer',
-                 '--no-loop-predicate-invariants',
-                 '--no-refinded-atomics',
-                 # '--no-smart-predication', # Most likely broken, disable
-                 '--no-uniformity-analysis',
-                 '--only-divergence',
-                 '--only-intra-group',
-                 '--only-requires',
-                 # '--parallel-inference', # Might bog down machine completely
-                 '--time',
-                 '--staged-inference',
-                 # r'--scheduling=[a-z-]+', # Not sure if safe
-                 '--verify',
-                 # '--verbose', # developer option, should not be visible
-                 r'--warp-sync=\d{1,3}',
-                 # OpenCL NDRange arguments
-                 r'--global_size=(\d+|\[\d+(,\d+){0,2}\])',
-                 r'--local_size=(\d+|\[\d+(,\d+){0,2}\])',
-                 r'--num_groups=(\d+|\[\d+(,\d+){0,2}\])',
-                 # CUDA grid arguments
-                 r'--blockDim=(\d+|\[\d+(,\d+){0,2}\])',
-                 r'--gridDim=(\d+|\[\d+(,\d+){0,2}\])'
-                ]
-
     for arg in foundArgs:
-      matcher=None
-      for option in safeOptions:
-        matcher=re.match(r'^' + option + r'$',arg)
-        if matcher:
-          args.append(matcher.group(0))
-          _logging.debug('Accepting command line option "' + args[-1] + '"')
-          break
-      # Warn about ignored args except the gridDim types as they are handled else where.
-      if matcher == None:
-        _logging.warning('Ignoring passed command line option "' + arg + '"')
+      if _safeOptionsRegex.match(arg):
+        args.append(arg)
+        _logging.debug('Accepting command line option "%s"', arg)
+      elif strict:
+        raise UnsafeOptionError(arg)
+      else:
+        # Warn about ignored args
+        _logging.warning('Ignoring passed command line option "%s"', arg)
         if ignoredArgs != None:
           ignoredArgs.append(arg)
 
@@ -178,41 +314,104 @@ class GPUVerifyTool(object):
     if timeout <= 0:
       raise Exception('timeout must be positive')
 
-    cmdArgs.append("--timeout=" + str(timeout))
-
-
-    # Create source file inside self.tempDir
-    f = tempfile.NamedTemporaryFile(prefix='gpuverify-source-',
-                                    suffix=fileExtension,
-                                    delete=False,
-                                    dir=self.tempDir)
-    response=None
-    try:
-      f.write(source.encode('utf8'))
-      f.close()
+    cacheKey = None
+    if self.cacheSize > 0:
+      # Argument order is kept as later arguments may override earlier ones
+      cacheKey = (hashlib.sha1(source.encode('utf8')).digest(), fileExtension, tuple(cmdArgs), timeout)
 
-      # Add sourcefile name to cmdArgs
-      cmdArgs.append(f.name)
+    cmdArgs.append("--timeout=" + str(timeout))
 
-      response = self.__runTool(cmdArgs)
-      if response[0] == ErrorCodes.TIMEOUT:
-        _logging.error('GPUVerify timed out (ErrorCode:{})'.format(response[0]))
+    cached = self.__cache.pop(cacheKey, None)
+    if cached:
+      _logging.debug('Using cached result')
+      self.__cache[cacheKey] = cached # Mark as most recently used
 
-    finally:
-      f.close()
-      os.remove(f.name)
+      # Add the sourcefile name of the cached run to cmdArgs so that cmdArgs
+      # matches the cached output and looks the same as for an uncached run
+      (response, sourceFileName) = cached
+      cmdArgs.append(sourceFileName)
+    else:
+      # Create source file inside the working directory GPUVerify runs in.
+      # GPUVerify puts its intermediate files next to the source file so
+      # this way emptying the working directory removes them too, even if
+      # GPUVerify was killed before it could clean up after itself.
+      workingDir = self.__checkoutWorkingDir()
+      try:
+        f = tempfile.NamedTemporaryFile(prefix='gpuverify-source-',
+                                        suffix=fileExtension,
+                                        delete=False,
+                                        dir=workingDir)
+        f.write(source.encode('utf8'))
+        f.close()
+
+        # Add sourcefile name to cmdArgs
+        cmdArgs.append(f.name)
+
+        response = self.__runTool(cmdArgs,
+                                  self.__notifyChunk if self.__chunkReceivers else None,
+                                  len(Tools) * timeout + _timeoutGracePeriod,
+                                  workingDir)
+        if response[0] == ErrorCodes.TIMEOUT:
+          _logging.error('GPUVerify timed out (ErrorCode:%s)', response[0])
+
+      finally:
+        self.__returnWorkingDir(workingDir)
+
+      # Timeouts depend on how busy the machine was, Ctrl-C and configuration
+      # errors say nothing about the kernel and a negative return code means
+      # GPUVerify could not be run so do not remember any of these.
+      if (cacheKey and response[0] >= 0 and
+          response[0] not in (ErrorCodes.TIMEOUT, ErrorCodes.CTRL_C, ErrorCodes.CONFIGURATION_ERROR)):
+        self.__cache[cacheKey] = (response, f.name)
+        if len(self.__cache) > self.cacheSize:
+          self.__cache.popitem(last=False) # Evict least recently used
 
     # Invoke any observers on the outcome of running the command
-    for observer in self.observers:
-      # Do not allow observers to cause their exceptions to cause the complete execution to fail.
-      try:
-        _logging.debug("Executing Observer " + str(observer.__class__))
-        observer.receive( source, cmdArgs, response[0], response[1])
-      except Exception as e:
-        _logging.error("Observer " + str(observer.__class__) + " raised exception " + str(e) + '\n' + traceback.format_exc()  )
+    if self.__receivers:
+      # Copy cmdArgs as the caller owns it and may change it
+      self.__queueNotification(self.__receivers, (source, list(cmdArgs), response[0], response[1]))
 
     return response
 
+  def __notifyChunk(self, line):
+    self.__queueNotification(self.__chunkReceivers, (line,))
+
+  def __queueNotification(self, receivers, notificationArgs):
+    """
+        Queue calling each method in receivers with notificationArgs on the
+        observer thread, starting the thread if necessary.
+    """
+    # Commands can be run from several threads at once so checking for and
+    # starting the thread has to be done under the lock
+    with self.__observerThreadLock:
+      if not self.__observerThread:
+        self.__observerThread = threading.Thread(target=self.__notifyObservers,
+                                                 name='GPUVerifyObserverThread')
+        self.__observerThread.daemon = True
+        self.__observerThread.start()
+
+      self.__observerQueue.put( (receivers, notificationArgs) )
+
+  def __notifyObservers(self):
+    """
+        Run by the observer thread. Performs each notification put on
+        self.__observerQueue (in order) until None is received.
+    """
+    while True:
+      notification = self.__observerQueue.get()
+      if notification == None:
+        return
+
+      (receivers, notificationArgs) = notification
+      for receive in receivers:
+        # Do not allow observers to cause their exceptions to cause the complete execution to fail.
+        try:
+          _logging.debug("Executing Observer %s", receive.__self__.__class__)
+          receive(*notificationArgs)
+        except Exception as e:
+          # exc_info only formats the traceback if the message is logged
+          _logging.error("Observer %s raised exception %s", receive.__self__.__class__, e, exc_info=True)
+
 
   def runCUDA(self, source, args, timeout=10):
     return self.__runCommon( source, args, '.cu', timeout)
@@ -220,51 +419,134 @@ class GPUVerifyTool(object):
 
 
 
-  def getVersionString(self):
+  def getVersionString(self, reload=False):
+    """
+        Return the tuple ( localID, changesetID ) identifying the version of
+        GPUVerify. GPUVerify is only run to find this the first time (or if
+        reload is True) as the version doesn't change while it is being used.
+    """
+    if self.__version and not reload:
+      return self.__version
+
     ( returnCode, versionString ) = self.__runTool(['--version'])
     if returnCode == 0:
 
-      # Parse version string
-      matcher = re.search(r'local-revision\s+:\s+(\d+)',versionString)
-      if not matcher:
-        raise Exception('Could not parse local-revision string from "' + versionString + '"')
-      localID=matcher.group(1)
+      # Parse version string, keeping the first match of each line
+      localID=None
+      changesetID=None
+      for matcher in _versionRegex.finditer(versionString):
+        if localID == None:
+          localID = matcher.group('localID')
+        if changesetID == None:
+          changesetID = matcher.group('changesetID')
+        if localID and changesetID:
+          break
 
-      matcher = re.search(r'vcgen\s+:\s+([a-z0-9]+)',versionString)
-      if not matcher:
+      if not localID:
+        raise Exception('Could not parse local-revision string from "' + versionString + '"')
+      if not changesetID:
         raise Exception('Could not parse vcgen string from "' + versionString + '"')
-      changesetID=matcher.group(1)
 
-      return (localID, changesetID)
+      self.__version = (localID, changesetID)
+      return self.__version
 
     else:
       raise Exception('Could not get version')
 
 
-  def __runTool(self, cmdLineArgs):
-    # Make temporary working directory inside self.tempDir
-    tempDir = tempfile.mkdtemp(prefix='gpuverify-working-directory-temp',dir=self.tempDir)
+  def __checkoutWorkingDir(self):
+    try:
+      return self.__idleWorkingDirs.pop()
+    except IndexError:
+      # Make temporary working directory inside self.tempDir
+      return tempfile.mkdtemp(prefix='gpuverify-working-directory-temp',dir=self.tempDir)
+
+  def __returnWorkingDir(self, workingDir):
+    # Remove anything GPUVerify left behind so the next run starts with an
+    # empty directory
+    try:
+      for name in os.listdir(workingDir):
+        path = os.path.join(workingDir, name)
+        try:
+          os.remove(path)
+        except OSError:
+          # GPUVerify should only leave files behind so rmtree() is only
+          # needed for the unusual case of a directory
+          shutil.rmtree(path)
+    except OSError as e:
+      _logging.warning('Could not empty working directory "%s" (%s)', workingDir, e)
+      shutil.rmtree(workingDir, ignore_errors=True)
+    else:
+      self.__idleWorkingDirs.append(workingDir)
+
+  def __runTool(self, cmdLineArgs, lineCallback=None, timeout=None, workingDir=None):
+    """
+        Run GPUVerify with cmdLineArgs and return ( returnCode, output ).
+        output is left as the undecoded byte string (str) read from GPUVerify,
+        callers should decode it only if they need to.
+        If lineCallback is not None then it is called with each line of
+        output as it is produced.
+        If timeout is not None then GPUVerify and all of its tools are
+        killed after that many seconds and ErrorCodes.TIMEOUT is returned
+        with the output produced so far.
+        If workingDir is not None then GPUVerify is run in it and the caller
+        is responsible for returning it, otherwise a working directory is
+        checked out for the duration of the run.
+    """
+    tempDir = workingDir or self.__checkoutWorkingDir()
 
     returnCode = 0
     message=""
+    timer = None
+    timedOut = [ False ] # A list so the timer thread can set it
     try:
-      cmdArgs = [ sys.executable, self.toolPath ] + cmdLineArgs
-      _logging.debug('Running :' + str(cmdArgs))
+      cmdArgs = list(self.__argvPrefix) + cmdLineArgs
+      _logging.debug('Running :%s', cmdArgs)
       process = subprocess.Popen( cmdArgs,
                                     stdin = subprocess.PIPE,
                                     stdout = subprocess.PIPE,
                                     stderr = subprocess.STDOUT,
+                                    bufsize = -1, # Python 2 defaults to unbuffered which makes readline() read a byte at a time
                                     cwd = tempDir,
                                     preexec_fn=os.setsid) # Make Sure GPUVerify can't kill us!
 
-      message, _NOT_USED = process.communicate() # Run tool
-      returnCode = process.returncode
+      process.stdin.close()
+
+      if timeout:
+        def killProcessGroup():
+          # Set the flag before killing so the reader can never see the
+          # return code of the kill without also seeing the flag
+          timedOut[0] = True
+          try:
+            # GPUVerify is the leader of its own process group (see os.setsid above)
+            os.killpg(process.pid, signal.SIGKILL)
+          except OSError:
+            timedOut[0] = False # Already finished
+        timer = threading.Timer(timeout, killProcessGroup)
+        timer.daemon = True
+        timer.start()
+
+      # Read output as it is produced rather than all at once
+      # so that it can be passed on while GPUVerify is running
+      lines = [ ]
+      for line in iter(process.stdout.readline, ''):
+        lines.append(line)
+        if lineCallback:
+          lineCallback(line)
+      process.stdout.close()
+      message = ''.join(lines)
+      returnCode = process.wait()
+      if timedOut[0]:
+        _logging.error('Killed GPUVerify after %s seconds', timeout)
+        returnCode = ErrorCodes.TIMEOUT
     except OSError as e:
       returnCode=-1
       message = 'Internal error. Could not run "' + self.toolPath + '"'
     finally:
-      # Remove the tempDir
-      shutil.rmtree(tempDir)
+      if timer:
+        timer.cancel()
+      if not workingDir:
+        self.__returnWorkingDir(tempDir)
 
     return ( returnCode, message )
 